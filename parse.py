@@ -1,5 +1,11 @@
 import sys
+import os
+import io
+import functools
+import collections
 import struct
+import re
+import hashlib
 
 cp437 = (
     " ☺☻♥♦♣♠•◘○◙♂♀♪♫☼"
@@ -31,16 +37,51 @@ def hexdump(pos, b):
                 dfdecode(line),
                 )
 
+# Large regions are read and dumped this many bytes at a time.
+# Must be a multiple of the hexdump line length.
+chunk_size = 2**16
+
+# Default for the digest option of Bytes and Rest: dump a summary
+# instead of a hexdump. Set by --digest.
+digest_dumps = False
+
+def digest(pos, chunks, min_run=256):
+    # Summarize a region without holding it in memory: its SHA-256,
+    # its zero runs of at least min_run bytes, and its zero byte count.
+    h = hashlib.sha256()
+    length = zeros = 0
+    run = None
+    for s in chunks:
+        h.update(s)
+        zeros += s.count(b'\0')
+        if run is not None and not s.startswith(b'\0'):
+            if pos + length - run >= min_run:
+                yield '%08x  %d zero bytes' % (run, pos + length - run)
+            run = None
+        for m in re.finditer(b'\0+', s):
+            if run is None:
+                run = pos + length + m.start()
+            if m.end() < len(s):
+                end = pos + length + m.end()
+                if end - run >= min_run:
+                    yield '%08x  %d zero bytes' % (run, end - run)
+                run = None
+        length += len(s)
+    if run is not None and pos + length - run >= min_run:
+        yield '%08x  %d zero bytes' % (run, pos + length - run)
+    yield '%08x  %d bytes, %d zero, sha256 %s' % (pos, length, zeros,
+            h.hexdigest())
+
 class RecallFile(object):
     def __init__(self, fp):
         self._fp = fp
         self._buffers = []
 
     def push(self):
-        self._buffers.append(b'')
+        self._buffers.append(bytearray())
 
     def pop(self):
-        s = self._buffers.pop()
+        s = bytes(self._buffers.pop())
         if self._buffers:
             self._buffers[-1] += s
         return s
@@ -51,6 +92,33 @@ class RecallFile(object):
             self._buffers[-1] += s
         return s
 
+    def read_chunks(self, n=None):
+        # Read n bytes (or up to EOF) in pieces of at most chunk_size.
+        while n is None or n > 0:
+            s = self.read(chunk_size if n is None else min(chunk_size, n))
+            if not s:
+                break
+            if n is not None:
+                n -= len(s)
+            yield s
+
+    def skip(self, n=None):
+        # Seek past n bytes (or to EOF) unless they have to be recorded.
+        # Like reading, skipping past EOF is an error.
+        if self._buffers:
+            for s in self.read_chunks(n):
+                if n is not None:
+                    n -= len(s)
+            if n:
+                raise Exception("Unexpected end of file")
+        elif n is None:
+            self._fp.seek(0, 2)
+        else:
+            pos = self._fp.tell()
+            if self._fp.seek(0, 2) < pos + n:
+                raise Exception("Unexpected end of file")
+            self._fp.seek(pos + n)
+
     def seek(self, n):
         return self._fp.seek(n)
 
@@ -62,6 +130,11 @@ class Format(object):
         self.args = args
         self.kwargs = kwargs
 
+    def __repr__(self):
+        args = [repr(a) for a in self.args]
+        args += ['%s=%r' % kv for kv in sorted(self.kwargs.items())]
+        return '%s(%s)' % (type(self).__name__, ', '.join(args))
+
     def skip(self, fp):
         for i in self.dump(fp):
             pass
@@ -92,6 +165,13 @@ class MultiFormat(Format):
     def parse(self, fp):
         return [fmt.parse(fp) for fmt in self.get_formats(fp)]
 
+    def build(self, values):
+        formats = self.get_formats(None)
+        if len(formats) != len(values):
+            raise Exception("Expected %d values, got %d"
+                    % (len(formats), len(values)))
+        return b''.join(fmt.build(v) for fmt, v in zip(formats, values))
+
     def skip(self, fp):
         for fmt in self.get_formats(fp):
             fmt.skip(fp)
@@ -121,7 +201,7 @@ class MultiFormat(Format):
                     yield '%s%s' % (indent,
                             'Exception raised when parsing at 0x%08x:' % pos)
                     fp.seek(pos)
-                    yield from Bytes(0x100).dump(fp)
+                    yield from Bytes(0x100, digest=False).dump(fp)
                     raise
                 #yield 'Length: %d' % (fp.tell() - pos)
 
@@ -141,6 +221,12 @@ class Struct(Atom):
     def parse(self, fp):
         return self._struct.unpack(fp.read(self._struct.size))[0]
 
+    def build(self, value):
+        return self._struct.pack(value)
+
+    def skip(self, fp):
+        fp.skip(self._struct.size)
+
 class Byte(Struct):
     format = '<b'
 
@@ -157,6 +243,15 @@ class Pstring(Format):
             raise Exception("Pstring has negative length %d" % n)
         return fp.read(n)
 
+    def build(self, value):
+        return Short().build(len(value)) + value
+
+    def skip(self, fp):
+        n = Short().parse(fp)
+        if n < 0:
+            raise Exception("Pstring has negative length %d" % n)
+        fp.skip(n)
+
     def dump(self, fp):
         yield repr(self.parse(fp))
 
@@ -169,6 +264,12 @@ class DFstring(Format):
             raise Exception("DFstring is longer than 80: %d" % n)
         return fp.read(n).decode('cp437')
 
+    def build(self, value):
+        b = value.encode('cp437')
+        if len(b) > 80:
+            raise Exception("DFstring is longer than 80: %d" % len(b))
+        return Short().build(len(b)) + b
+
     def dump(self, fp):
         yield repr(self.parse(fp))
 
@@ -179,8 +280,13 @@ class Tuple(MultiFormat):
 
 class NamedTuple(Format):
     def parse(self, fp):
-        for k in self.args[0]:
-            yield (k, self.args[1].parse(fp))
+        return [(k, self.args[1].parse(fp)) for k in self.args[0]]
+
+    def get_formats(self, fp):
+        return len(self.args[0]) * (self.args[1],)
+
+    def build(self, items):
+        return b''.join(self.args[1].build(v) for k, v in items)
 
     def dump(self, fp):
         for k in self.args[0]:
@@ -204,6 +310,18 @@ class VectorInt(MultiFormat):
             raise Exception("Vector too large (0x%x)" % n)
         return n * (self.args[0],)
 
+    def build(self, values):
+        return Int().build(len(values)) + b''.join(
+                self.args[0].build(v) for v in values)
+
+    def skip(self, fp):
+        formats = self.get_formats(fp)
+        if isinstance(self.args[0], Struct):
+            fp.skip(len(formats) * self.args[0]._struct.size)
+        else:
+            for fmt in formats:
+                fmt.skip(fp)
+
 class Output(Format):
     def parse(self, fp):
         pass
@@ -222,6 +340,12 @@ class Expect(Format):
             raise Exception("Expected:\n%r\nGot:\n%r"
                     % (expected, got))
 
+    def build(self, value=None):
+        if value is not None and value != self.args[1]:
+            raise Exception("Expected:\n%r\nGot:\n%r"
+                    % (self.args[1], value))
+        return self.args[0].build(self.args[1])
+
     def dump(self, fp):
         self.parse(fp)
         yield from []
@@ -252,14 +376,31 @@ class ExpectZeros(Format):
         self.parse(fp)
         yield from []
 
+def dump_chunks(pos, chunks, digest_only=False):
+    if digest_only:
+        yield from digest(pos, chunks)
+    else:
+        for s in chunks:
+            yield from hexdump(pos, s)
+            pos += len(s)
+
 class Bytes(Atom):
     def parse(self, fp):
         return fp.read(self.args[0])
 
+    def build(self, value):
+        if len(value) != self.args[0]:
+            raise Exception("Expected %d bytes, got %d"
+                    % (self.args[0], len(value)))
+        return value
+
     def dump(self, fp):
         pos = fp.tell()
-        b = self.parse(fp)
-        yield from hexdump(pos, b)
+        yield from dump_chunks(pos, fp.read_chunks(self.args[0]),
+                self.kwargs.get('digest', digest_dumps))
+
+    def skip(self, fp):
+        fp.skip(self.args[0])
 
 class Rest(Format):
     def parse(self, fp):
@@ -267,12 +408,19 @@ class Rest(Format):
 
     def dump(self, fp):
         pos = fp.tell()
-        yield from hexdump(pos, fp.read())
+        yield from dump_chunks(pos, fp.read_chunks(),
+                self.kwargs.get('digest', digest_dumps))
+
+    def skip(self, fp):
+        fp.skip()
 
 class Break(Format):
     def parse(self, fp):
         return None
 
+    def skip(self, fp):
+        pass
+
     def dump(self, fp):
         yield 'Press a key to continue...'
         try:
@@ -379,300 +527,813 @@ def skip(do_skip, *args):
     else:
         return Tuple(args)
 
-subterranean_animal_peoples = make_tuple(
-    #Expect(Pstring(), b'SUBTERRANEAN_ANIMAL_PEOPLES'),
-    Expect(Short(), 0x19),
-    Expect(Short(), 0x4b),
-    Int(), # 1, 2, 3, ...
-    ExpectZeros(3),
-    Short(), # 524, 526, 517, 528, 529, 530, 511, 529
-    skip(True,
-        make_array(18,
+@functools.lru_cache()
+def build_subterranean_animal_peoples():
+    return make_tuple(
+        #Expect(Pstring(), b'SUBTERRANEAN_ANIMAL_PEOPLES'),
+        Expect(Short(), 0x19),
+        Expect(Short(), 0x4b),
+        Int(), # 1, 2, 3, ...
+        ExpectZeros(3),
+        Short(), # 524, 526, 517, 528, 529, 530, 511, 529
+        skip(True,
+            make_array(18,
+                vector_of_int,
+                vector_of_short,
+            ),
             vector_of_int,
-            vector_of_short,
-        ),
-        vector_of_int,
-        vector_of_int,
-        vector_of_short,
-        vector_of_int,
-        vector_of_short,
-        Int(),
-        Int(),
-        make_array(10,
             vector_of_int,
             vector_of_short,
-        ),
-        make_array(2,
+            vector_of_int,
             vector_of_short,
+            Int(),
+            Int(),
+            make_array(10,
+                vector_of_int,
+                vector_of_short,
+            ),
+            make_array(2,
+                vector_of_short,
+                vector_of_int,
+            ),
+            Expect(Int(), 0),
+            make_array(9,
+                vector_of_short,
+                vector_of_int,
+            ),
+            Bytes(0x12),
             vector_of_int,
+            make_array(2,
+                vector_of_short,
+                vector_of_int,
+            ),
+            Bytes(14),
+            make_array(15,
+                vector_of_short,
+                vector_of_int,
+            ),
+            make_array(2,
+                vector_of_int,
+                vector_of_short,
+            ),
         ),
-        Expect(Int(), 0),
-        make_array(9,
+        Expect(Int(), 1),
+        Short(),
+        Bytes(256),
+        Int(),
+    )
+
+@functools.lru_cache()
+def build_mountain():
+    return make_tuple(
+        #Expect(Pstring(), b'MOUNTAIN'),
+        Short(),
+        Short(),
+        Int(),
+        Bytes(0x3d),
+        make_array(18,
             vector_of_short,
             vector_of_int,
         ),
-        Bytes(0x12),
-        vector_of_int,
         make_array(2,
-            vector_of_short,
             vector_of_int,
+            vector_of_short,
         ),
-        Bytes(14),
-        make_array(15,
+        make_array(2,
             vector_of_short,
             vector_of_int,
         ),
-        make_array(2,
+        vector_of_short,
+        vector_of_short,
+        vector_of_short,
+        vector_of_int,
+        make_array(7,
             vector_of_int,
             vector_of_short,
         ),
-    ),
-    Expect(Int(), 1),
-    Short(),
-    Bytes(256),
-    Int(),
-)
-
-mountain = make_tuple(
-    #Expect(Pstring(), b'MOUNTAIN'),
-    Short(),
-    Short(),
-    Int(),
-    Bytes(0x3d),
-    make_array(18,
         vector_of_short,
         vector_of_int,
-    ),
-    make_array(2,
         vector_of_int,
-        vector_of_short,
-    ),
-    make_array(2,
-        vector_of_short,
         vector_of_int,
-    ),
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    vector_of_int,
-    make_array(7,
         vector_of_int,
+        make_array(9,
+            vector_of_short,
+            vector_of_int,
+        ),
+        Bytes(0x12),
+        vector_of_short,
+        vector_of_short,
+        vector_of_short,
+        vector_of_short,
+        vector_of_short,
         vector_of_short,
-    ),
-    vector_of_short,
-    vector_of_int,
-    vector_of_int,
-    vector_of_int,
-    vector_of_int,
-    make_array(9,
         vector_of_short,
+        vector_of_short,
+        vector_of_short,
+        vector_of_short,
+        vector_of_short,
+        vector_of_short,
+        vector_of_short,
+        vector_of_short,
+        vector_of_short,
+        make_array(10,
+            vector_of_short,
+            vector_of_int,
+        ),
+
+        VectorInt(make_tuple(Short(), Int(), Short())),
+        Bytes(16),
+        vector_of_int,
+        vector_of_int,
         vector_of_int,
-    ),
-    Bytes(0x12),
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    vector_of_short,
-    make_array(10,
         vector_of_short,
+        Bytes(14*16-2),
+        Bytes(14),
+        vector_of_int,
+        vector_of_byte,
         vector_of_int,
-    ),
-
-    VectorInt(make_tuple(Short(), Int(), Short())),
-    Bytes(16),
-    vector_of_int,
-    vector_of_int,
-    vector_of_int,
-    vector_of_short,
-    Bytes(14*16-2),
-    Bytes(14),
-    vector_of_int,
-    vector_of_byte,
-    vector_of_int,
-
-    vector_of_int,
-)
+
+        vector_of_int,
+    )
 
 class DFNamedSections(Format):
-    def parse(self, fp):
+    # The section formats are passed in (rather than looked up as globals)
+    # so that they are part of repr() and thus of the schema fingerprint.
+    def get_sections(self, fp):
+        # Yields (name, format); each format must be consumed from fp
+        # before the next name is read.
         while True:
             n = Pstring().parse(fp)
             if n == b'SUBTERRANEAN_ANIMAL_PEOPLES':
-                yield subterranean_animal_peoples.parse(fp)
+                yield n, self.args[0]
             elif n == b'MOUNTAIN':
-                yield mountain.parse(fp)
+                yield n, self.args[1]
                 return
 
+    def parse(self, fp):
+        return [fmt.parse(fp) for n, fmt in self.get_sections(fp)]
+
+    def skip(self, fp):
+        for n, fmt in self.get_sections(fp):
+            fmt.skip(fp)
+
+    def build(self, values):
+        # All but the last value are SUBTERRANEAN_ANIMAL_PEOPLES records.
+        return b''.join(
+                [Pstring().build(b'SUBTERRANEAN_ANIMAL_PEOPLES')
+                    + self.args[0].build(v) for v in values[:-1]]
+                + [Pstring().build(b'MOUNTAIN') + self.args[1].build(values[-1])])
+
     def dump(self, fp):
         i = 0
-        while True:
-            n = Pstring().parse(fp)
+        for n, fmt in self.get_sections(fp):
             if n == b'SUBTERRANEAN_ANIMAL_PEOPLES':
-                for line in subterranean_animal_peoples.dump(fp):
+                for line in fmt.dump(fp):
                     yield '#%d %s' % (i, line)
                 i = i + 1
-            elif n == b'MOUNTAIN':
+            else:
                 yield 'Done processing SUBTERRANEAN_ANIMAL_PEOPLES'
-                yield from mountain.dump(fp)
-                return
-
-world_header = make_tuple(
-    Short(),
-    Array(16, Int(), short=True),
-    Bytes(104),
-    # World name
-    DFstring(),
+                yield from fmt.dump(fp)
+
+@functools.lru_cache()
+def build_world_header():
+    return make_tuple(
+        Short(),
+        Array(16, Int(), short=True),
+        Bytes(104),
+        # World name
+        DFstring(),
+    )
+
+# Positions following the named sections: the number of unknown bytes
+# preceding each position, and the position name.
+positions = (
+    (0x84, 'MONARCH'),
+    (0x6f, 'GENERAL'),
+    (0x77, 'LIEUTENANT'),
+    (0x77, 'CAPTAIN'),
+    (0x6d, 'OUTPOST_LIAISON'),
+    (0x77, 'DIPLOMAT'),
+    (0x7b, 'MILITIA_COMMANDER'),
+    (0x7f, 'MILITIA_CAPTAIN'),
+    (0x6d, 'SHERIFF'),
+    (0x7f, 'CAPTAIN_OF_THE_GUARD'),
+    (0x75, 'EXPEDITION_LEADER'),
+    (0x6f, 'MAYOR'),
+    (0x6f, 'MANAGER'),
+    (0x7f, 'CHIEF_MEDICAL_DWARF'),
+    (0x7f, 'BROKER'),
+    (0x7f, 'BOOKKEEPER'),
+    (0x7f, 'DUKE'),
+    (0x77, 'COUNT'),
+    (0x77, 'BARON'),
+    (0x77, 'CHAMPION'),
+    (0x87, 'HAMMERER'),
+    (0x83, 'FORCED_ADMINISTRATOR'),
 )
 
-world_dat = make_tuple(
-    skip(True, world_header),
-    skip(True,
-        # Generated raw blocks
-        NamedTuple(
-            ("inorganic_generated", "unknown layer",
-                "creature_layer", "interaction_layer"),
-            VectorInt(
-                # Raw block
+def make_positions(table):
+    formats = []
+    for padding, name in table:
+        formats += [
+            Bytes(padding),
+            Expect(DFstring(), name),
+            Bytes(28),
+            make_array(16, DFstring()),
+        ]
+    return formats
+
+# Maps the version short at the start of world.dat to a schema builder.
+world_schemas = {}
+
+def world_schema(*versions):
+    def register(build):
+        for version in versions:
+            world_schemas[version] = build
+        return build
+    return register
+
+def get_world_schema(version, assume=None):
+    # If assume is given, versions without a schema of their own are
+    # parsed with the schema of version assume.
+    if version not in world_schemas and assume is not None:
+        version = assume
+    try:
+        build = world_schemas[version]
+    except KeyError:
+        raise Exception("No schema for world.dat version %d" % version)
+    return build()
+
+def read_version(fp):
+    pos = fp.tell()
+    version = Short().parse(fp)
+    fp.seek(pos)
+    return version
+
+# DF 0.34.11
+@world_schema(1205)
+@functools.lru_cache()
+def build_world_dat():
+    return make_tuple(
+        skip(True, build_world_header()),
+        skip(True,
+            # Generated raw blocks
+            NamedTuple(
+                ("inorganic_generated", "unknown layer",
+                    "creature_layer", "interaction_layer"),
                 VectorInt(
-                    # Raw
-                    Pstring()
+                    # Raw block
+                    Memo(VectorInt(
+                        # Raw
+                        Pstring()
+                    )),
                 ),
             ),
-        ),
-        # Tag blocks
-        NamedTuple("""
-            Material Plant Body1 Body2 Creature Item Workshop EntityCiv Word
-            NameTag MainCiv Color1 Shape Color2 Reaction MaterialTemplate
-            TissueTemplate BodyDetailPlan CreatureVariation Interaction
-            """.split(),
-            # Tag block
-            VectorInt(
-                # Tag
-                Pstring(),
+            # Tag blocks
+            NamedTuple("""
+                Material Plant Body1 Body2 Creature Item Workshop EntityCiv Word
+                NameTag MainCiv Color1 Shape Color2 Reaction MaterialTemplate
+                TissueTemplate BodyDetailPlan CreatureVariation Interaction
+                """.split(),
+                # Tag block
+                Memo(VectorInt(
+                    # Tag
+                    Pstring(),
+                )),
             ),
+            VectorInt(Tuple((Int(), Int())), short=True),
+            Expect(Int(), 0),
+            vector_of_int,
+            vector_of_int,
         ),
-        VectorInt(Tuple((Int(), Int())), short=True),
-        Expect(Int(), 0),
-        vector_of_int,
-        vector_of_int,
-    ),
-    skip(True,
-        vector_of_int,
-        ExpectZeros(20),
-        vector_of_int,
-        vector_of_int,
-        VectorInt(Int()),
-    ),
-    #Bytes(18),
-    Bytes(0x100),
-    Break(),
-    DFNamedSections(),
-    Output('Begin processing MONARCH, GENERAL et al'),
-    Bytes(0x84),
-    Expect(DFstring(), 'MONARCH'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x6f),
-    Expect(DFstring(), 'GENERAL'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x77),
-    Expect(DFstring(), 'LIEUTENANT'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x77),
-    Expect(DFstring(), 'CAPTAIN'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x6d),
-    Expect(DFstring(), 'OUTPOST_LIAISON'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x77),
-    Expect(DFstring(), 'DIPLOMAT'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x7b),
-    Expect(DFstring(), 'MILITIA_COMMANDER'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x7F),
-    Expect(DFstring(), 'MILITIA_CAPTAIN'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x6D),
-    Expect(DFstring(), 'SHERIFF'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x7F),
-    Expect(DFstring(), 'CAPTAIN_OF_THE_GUARD'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x75),
-    Expect(DFstring(), 'EXPEDITION_LEADER'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x6F),
-    Expect(DFstring(), 'MAYOR'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x6F),
-    Expect(DFstring(), 'MANAGER'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x7F),
-    Expect(DFstring(), 'CHIEF_MEDICAL_DWARF'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x7F),
-    Expect(DFstring(), 'BROKER'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x7F),
-    Expect(DFstring(), 'BOOKKEEPER'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x7F),
-    Expect(DFstring(), 'DUKE'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x77),
-    Expect(DFstring(), 'COUNT'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x77),
-    Expect(DFstring(), 'BARON'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x77),
-    Expect(DFstring(), 'CHAMPION'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x87),
-    Expect(DFstring(), 'HAMMERER'),
-    Bytes(28),
-    make_array(16, DFstring()),
-    Bytes(0x83),
-    Expect(DFstring(), 'FORCED_ADMINISTRATOR'),
-    Bytes(28),
-    make_array(16, DFstring()),
-
-    #Output(75 * '='),
-    #Output("Rest:"),
-    #Rest()
-)
+        skip(True,
+            vector_of_int,
+            ExpectZeros(20),
+            vector_of_int,
+            vector_of_int,
+            VectorInt(Int()),
+        ),
+        #Bytes(18),
+        Bytes(0x100),
+        Break(),
+        DFNamedSections(
+            Memo(build_subterranean_animal_peoples()),
+            build_mountain()),
+        Output('Begin processing MONARCH, GENERAL et al'),
+        *make_positions(positions),
+        #Output(75 * '='),
+        #Output("Rest:"),
+        #Rest()
+    )
+
+# Schemas are built on first use; keep the old module attributes working.
+lazy_schemas = {
+    'subterranean_animal_peoples': build_subterranean_animal_peoples,
+    'mountain': build_mountain,
+    'world_header': build_world_header,
+    'world_dat': build_world_dat,
+}
+
+def __getattr__(name):
+    try:
+        return lazy_schemas[name]()
+    except KeyError:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+
+def schema_fingerprint(fmt):
+    # marshal.version is included since cache entries are stored with marshal.
+    import marshal
+    s = '%d %r' % (marshal.version, fmt)
+    return hashlib.sha256(s.encode()).hexdigest()
+
+def file_digest(fp, chunk_size=2**20):
+    pos = fp.tell()
+    h = hashlib.sha256()
+    while True:
+        s = fp.read(chunk_size)
+        if not s:
+            break
+        h.update(s)
+    fp.seek(pos)
+    return h.hexdigest()
+
+class ParseCache(object):
+    # On-disk cache of the parse results of the sections of a Tuple.
+    # Each section is stored with marshal under the hash of its schema
+    # fingerprint and its bytes, so any schema edit invalidates it.
+    # An index keyed by the hash of the remaining input maps to the section
+    # keys. When the cache grows beyond max_size bytes, the least recently
+    # used entries are removed. Entry sizes and recency are tracked in
+    # memory; the directory is only listed once, when the cache is opened.
+
+    def __init__(self, path, max_size=256*2**20):
+        self._path = path
+        self._max_size = max_size
+        os.makedirs(path, exist_ok=True)
+        entries = []
+        for name in os.listdir(path):
+            try:
+                st = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, name, st.st_size))
+        self._entries = collections.OrderedDict(
+                (name, size) for mtime, name, size in sorted(entries))
+        self._size = sum(self._entries.values())
+
+    def _load(self, key):
+        import marshal
+        path = os.path.join(self._path, key)
+        try:
+            with open(path, 'rb') as fp:
+                value = marshal.load(fp)
+        except (OSError, EOFError, ValueError, TypeError):
+            raise KeyError(key)
+        os.utime(path)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+        return value
+
+    def _store(self, key, value):
+        import marshal
+        path = os.path.join(self._path, key)
+        with open(path + '.tmp', 'wb') as fp:
+            marshal.dump(value, fp)
+            size = fp.tell()
+        os.replace(path + '.tmp', path)
+        self._size += size - self._entries.pop(key, 0)
+        self._entries[key] = size
+        if self._size > self._max_size:
+            self._evict()
+
+    def _evict(self):
+        while self._size > self._max_size and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self._path, name))
+            except OSError:
+                pass
+
+    def parse(self, fmt, fp):
+        pos = fp.tell()
+        sections = fmt.get_formats(fp)
+        h = hashlib.sha256(schema_fingerprint(fmt).encode())
+        h.update(file_digest(fp).encode())
+        index_key = 'index-%s' % h.hexdigest()
+        try:
+            length, keys = self._load(index_key)
+            result = [self._load(key) for key in keys]
+        except KeyError:
+            pass
+        else:
+            fp.seek(pos + length)
+            return result
+
+        # Sections that are unchanged since an earlier parse are found by
+        # measuring their span with skip and are not decoded again.
+        result = []
+        keys = []
+        for section in sections:
+            fp.push()
+            section.skip(fp)
+            b = fp.pop()
+            h = hashlib.sha256(schema_fingerprint(section).encode())
+            h.update(b)
+            key = 'section-%s' % h.hexdigest()
+            try:
+                value = self._load(key)
+            except KeyError:
+                value = section.parse(RecallFile(io.BytesIO(b)))
+                self._store(key, value)
+            result.append(value)
+            keys.append(key)
+        self._store(index_key, (fp.tell() - pos, keys))
+        return result
+
+
+def locate(fmt, path, fp):
+    # Parse up to the format at the given path of indices into nested
+    # Tuples, Arrays, vectors, NamedTuples and DFNamedSections (indexed
+    # like the list its parse returns), and return that format with fp
+    # positioned at its start.
+    for index in path:
+        while isinstance(fmt, (Skip, Memo)):
+            fmt = fmt.args[0]
+        if isinstance(fmt, DFNamedSections):
+            for i, (n, f) in enumerate(fmt.get_sections(fp)):
+                if i == index:
+                    break
+                f.parse(fp)
+            else:
+                raise Exception("No named section %d" % index)
+            fmt = f
+            continue
+        formats = fmt.get_formats(fp)
+        for f in formats[:index]:
+            f.parse(fp)
+        fmt = formats[index]
+    return fmt
+
+def read_region(fmt, path, fp):
+    # Return the parse result at path, e.g. the bytes of an unknown
+    # Bytes(n) region.
+    return locate(fmt, path, fp).parse(fp)
+
+def copy_range(src, dest, n):
+    while n > 0:
+        s = src.read(min(chunk_size, n))
+        if not s:
+            raise Exception("Unexpected end of file")
+        dest.write(s)
+        n -= len(s)
+
+def patch(path, edits, fmt=None, assume=None):
+    # Apply edits, a list of (schema path, value), to the file at path.
+    # Each value is encoded with the Format found at its schema path.
+    # If no encoded size changes, the bytes are patched in place through
+    # a writable mmap; otherwise the file is rewritten by a streamed copy.
+    import mmap
+    import shutil
+    spans = []
+    with open(path, 'rb') as f:
+        fp = RecallFile(f)
+        if fmt is None:
+            fmt = get_world_schema(read_version(fp), assume)
+        for field_path, value in edits:
+            fp.seek(0)
+            leaf = locate(fmt, field_path, fp)
+            start = fp.tell()
+            leaf.parse(fp)
+            spans.append((start, fp.tell(), leaf.build(value)))
+    spans.sort(key=lambda span: span[0])
+    for (a, b, data), (c, d, _) in zip(spans, spans[1:]):
+        if b > c:
+            raise Exception("Overlapping edits at 0x%08x and 0x%08x" % (a, c))
+
+    if all(end - start == len(data) for start, end, data in spans):
+        with open(path, 'r+b') as f:
+            with mmap.mmap(f.fileno(), 0) as m:
+                for start, end, data in spans:
+                    m[start:end] = data
+        return
+
+    tmp_path = path + '.tmp'
+    try:
+        with open(path, 'rb') as src, open(tmp_path, 'wb') as dest:
+            pos = 0
+            for start, end, data in spans:
+                copy_range(src, dest, start - pos)
+                dest.write(data)
+                src.seek(end)
+                pos = end
+            while True:
+                s = src.read(chunk_size)
+                if not s:
+                    break
+                dest.write(s)
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    except:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+Candidate = collections.namedtuple('Candidate', 'offset kind score details')
+
+def scan_region(b, max_count=0x10000, min_run=4):
+    # Propose plausible fields in a single unknown region.
+    # Returns a list of (offset, kind, detail, end), where end is the
+    # offset just past the proposed field.
+    import numpy as np
+    a = np.frombuffer(b, dtype=np.uint8).astype(np.int64)
+    n = len(a)
+    found = []
+
+    # int32 count followed by that many shorts or ints
+    if n >= 4:
+        count = a[:-3] | a[1:-2] << 8 | a[2:-1] << 16 | a[3:] << 24
+        count = np.where(count >= 2**31, count - 2**32, count)
+        offs = np.arange(len(count))
+        # An empty vector is only proposed where a run of zeros starts;
+        # every later offset in the run would read as one as well.
+        run_start = np.concatenate(([True], a[:-4] != 0))
+        for kind, size in (('vector_of_short', 2), ('vector_of_int', 4)):
+            end = offs + 4 + count * size
+            ok = (count >= 0) & (count <= max_count) & (end <= n)
+            ok &= (count > 0) | run_start
+            for o in np.flatnonzero(ok):
+                found.append((int(o), kind, int(count[o]), int(end[o])))
+
+    # Short length prefix followed by that many printable characters
+    if n >= 2:
+        length = a[:-1] | a[1:] << 8
+        length = np.where(length >= 2**15, length - 2**16, length)
+        offs = np.arange(len(length))
+        printable = (a >= 0x20) & (a < 0x7f)
+        cum = np.concatenate(([0], np.cumsum(printable)))
+        end = np.clip(offs + 2 + length, 0, n)
+        ok = (length > 0) & (offs + 2 + length <= n)
+        ok &= cum[end] - cum[np.minimum(offs + 2, n)] == length
+        for o in np.flatnonzero(ok):
+            kind = 'DFstring' if length[o] <= 80 else 'Pstring'
+            found.append((int(o), kind, bytes(b[o+2:end[o]]), int(end[o])))
+
+    # Runs of a repeated byte
+    if n:
+        change = np.flatnonzero(a[1:] != a[:-1]) + 1
+        starts = np.concatenate(([0], change))
+        ends = np.concatenate((change, [n]))
+        for s, e in zip(starts, ends):
+            if e - s >= min_run:
+                kind = 'zeros' if a[s] == 0 else 'constant'
+                found.append((int(s), kind, (int(e - s), int(a[s])), int(e)))
+    return found
+
+def agreement(kind, details):
+    # How well the details of one candidate agree across regions, in [0, 1].
+    if kind.startswith('vector'):
+        return (min(details) + 1) / (max(details) + 1)
+    if kind in ('zeros', 'constant'):
+        lengths = [length for length, value in details]
+        values = collections.Counter(value for length, value in details)
+        return (min(lengths) / max(lengths)
+                * values.most_common(1)[0][1] / len(details))
+    if kind == 'same':
+        # Identical bytes say nothing about field boundaries inside them.
+        return 0.5
+    # Strings: present everywhere is already a strong signal, but
+    # identical strings are stronger still.
+    mode = collections.Counter(details).most_common(1)[0][1]
+    return 0.5 + 0.5 * mode / len(details)
+
+def scan_regions(regions, max_count=0x10000, min_run=4):
+    # Propose layouts for the same unknown region taken from many saves.
+    # The score of a candidate is the product of the fraction of regions
+    # it occurs in, how well its details agree across those regions, and
+    # the fraction of those in which it ends where another plausible field
+    # starts (or at the end of the region).
+    import numpy as np
+    details = collections.defaultdict(list)
+    follows = collections.Counter()
+    starts = []
+    for b in regions:
+        found = scan_region(b, max_count, min_run)
+        starts.append({len(b)} | {offset for offset, kind, detail, end in found})
+        for offset, kind, detail, end in found:
+            details[offset, kind].append(detail)
+            follows[offset, kind] += end in starts[-1]
+
+    # Byte ranges that are identical in all regions
+    if len(regions) > 1:
+        n = min(len(b) for b in regions)
+        rows = np.array([np.frombuffer(b[:n], dtype=np.uint8) for b in regions])
+        same = np.concatenate(([False], (rows == rows[0]).all(axis=0), [False]))
+        edges = np.flatnonzero(same[1:] != same[:-1])
+        for s, e in zip(edges[::2], edges[1::2]):
+            if e - s >= min_run:
+                s, e = int(s), int(e)
+                details[s, 'same'] = len(regions) * [bytes(regions[0][s:e])]
+                follows[s, 'same'] = sum(e in each for each in starts)
+
+    candidates = []
+    for (offset, kind), d in details.items():
+        score = (len(d) / len(regions) * agreement(kind, d)
+                * follows[offset, kind] / len(d))
+        candidates.append(Candidate(offset, kind, score, d))
+    candidates.sort(key=lambda c: (-c.score, c.offset, c.kind))
+    return candidates
+
+def freeze(value):
+    # Replace lists with tuples, so the result can be shared.
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+def sizeof(value):
+    # Memory held by a frozen value. Objects shared between several
+    # values (small ints, interned strings) are counted every time.
+    n = sys.getsizeof(value)
+    if isinstance(value, tuple):
+        n += sum(sizeof(v) for v in value)
+    return n
+
+class MemoCache(object):
+    # In-memory map from the hash of a byte span to a frozen decoded value.
+    # When the total sizeof() of the values exceeds max_size bytes,
+    # the least recently used entries are dropped.
+    def __init__(self, max_size=64*2**20):
+        self._entries = collections.OrderedDict()
+        self._size = 0
+        self._max_size = max_size
+
+    def get(self, key):
+        value, size = self._entries[key]
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        if key in self._entries:
+            return
+        size = sizeof(value)
+        self._entries[key] = (value, size)
+        self._size += size
+        while self._size > self._max_size and self._entries:
+            k, (v, n) = self._entries.popitem(last=False)
+            self._size -= n
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+memo_cache = MemoCache()
+
+class Memo(Format):
+    # Parse args[0] once per distinct byte span, sharing the frozen result
+    # between all occurrences in all files parsed by this process.
+    # The span is found with args[0].skip, which only reads length prefixes.
+    def lookup(self, fp, kind, decode):
+        # Consume the span at fp and return decode(span), where decode
+        # is only called if no value of this kind is cached for the span.
+        fp.push()
+        self.args[0].skip(fp)
+        b = fp.pop()
+        if not hasattr(self, '_fingerprint'):
+            self._fingerprint = schema_fingerprint(self.args[0]).encode()
+        key = (kind, hashlib.sha256(self._fingerprint + b).digest())
+        try:
+            return memo_cache.get(key)
+        except KeyError:
+            pass
+        value = decode(RecallFile(io.BytesIO(b)))
+        memo_cache.put(key, value)
+        return value
 
+    def parse(self, fp):
+        return self.lookup(fp, 'parse',
+                lambda span: freeze(self.args[0].parse(span)))
+
+    def dump(self, fp):
+        # Not memoized: the output contains file offsets.
+        yield from self.args[0].dump(fp)
+
+    def skip(self, fp):
+        self.args[0].skip(fp)
+
+    def build(self, value):
+        return self.args[0].build(value)
+
+def walk(fmt, fp, path=()):
+    # Parse fmt, yielding (path, value) for each leaf value.
+    # Unlike parse, this also descends into Skip, and yields the expected
+    # value of each Expect (e.g. the name of a position).
+    while isinstance(fmt, Skip):
+        fmt = fmt.args[0]
+    if isinstance(fmt, Memo):
+        inner = fmt.args[0]
+        rows = fmt.lookup(fp, 'walk', lambda span: tuple(walk(inner, span)))
+        for p, value in rows:
+            yield path + p, value
+    elif isinstance(fmt, NamedTuple):
+        for k, f in zip(fmt.args[0], fmt.get_formats(fp)):
+            yield from walk(f, fp, path + (k,))
+    elif isinstance(fmt, MultiFormat):
+        for i, f in enumerate(fmt.get_formats(fp)):
+            yield from walk(f, fp, path + (i,))
+    elif isinstance(fmt, DFNamedSections):
+        counts = collections.Counter()
+        for n, f in fmt.get_sections(fp):
+            n = n.decode()
+            yield from walk(f, fp, path + (n, counts[n]))
+            counts[n] += 1
+    elif isinstance(fmt, Expect):
+        fmt.parse(fp)
+        yield path, fmt.args[1]
+    else:
+        value = fmt.parse(fp)
+        if value is not None:
+            yield path, value
+
+sqlite_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    sha256 TEXT NOT NULL UNIQUE,
+    version INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fields (
+    file_id INTEGER NOT NULL REFERENCES files (id),
+    section INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    value
+);
+"""
+
+sqlite_indexes = """
+CREATE INDEX IF NOT EXISTS fields_file ON fields (file_id, section, path);
+CREATE INDEX IF NOT EXISTS fields_section ON fields (section, path);
+CREATE INDEX IF NOT EXISTS fields_path ON fields (path);
+"""
+
+def load_world_dat(conn, world_dat_path, batch_size=10000, assume=None):
+    # Load every leaf field of one world.dat in a single transaction,
+    # unless its content hash is already in the files table.
+    # Returns a status line.
+    with open(world_dat_path, 'rb') as world_dat_fp:
+        fp = RecallFile(world_dat_fp)
+        sha256 = file_digest(fp)
+        if conn.execute('SELECT 1 FROM files WHERE sha256 = ?',
+                (sha256,)).fetchone():
+            return 'Skipping %s (already loaded)' % world_dat_path
+        version = read_version(fp)
+        world_dat = get_world_schema(version, assume)
+        with conn:
+            file_id = conn.execute(
+                    'INSERT INTO files (path, sha256, version) '
+                    'VALUES (?, ?, ?)',
+                    (world_dat_path, sha256, version)).lastrowid
+            rows = []
+            n = 0
+            for path, value in walk(world_dat, fp):
+                rows.append((file_id, path[0],
+                    '.'.join(str(k) for k in path[1:]), value))
+                if len(rows) >= batch_size:
+                    conn.executemany('INSERT INTO fields VALUES (?, ?, ?, ?)',
+                            rows)
+                    n += len(rows)
+                    rows = []
+            conn.executemany('INSERT INTO fields VALUES (?, ?, ?, ?)', rows)
+            n += len(rows)
+    return 'Loaded %s (%d fields)' % (world_dat_path, n)
+
+def export_sqlite(db_path, world_dat_paths, batch_size=10000, assume=None,
+        log=None):
+    # Load each world.dat into the database at db_path and build the
+    # indexes. A file that fails to load is rolled back and reported,
+    # and the remaining files are still loaded. Returns the status lines,
+    # also passing each to log as soon as it is known.
+    import sqlite3
+    lines = []
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(sqlite_schema)
+        for world_dat_path in world_dat_paths:
+            try:
+                line = load_world_dat(conn, world_dat_path, batch_size, assume)
+            except (KeyboardInterrupt, SystemExit):
+                raise
+            except Exception as e:
+                line = 'Failed %s: %s' % (world_dat_path, e)
+            lines.append(line)
+            if log is not None:
+                log(line)
+        conn.executescript(sqlite_indexes)
+    finally:
+        conn.close()
+    return lines
 
 
 class WorldDatParser(Parser):
@@ -779,6 +1440,7 @@ class WorldDatParser(Parser):
         version = self.parse_short()
         self.skip(168)
         self.output("Version %s", version)
+        return version
 
     def dump_world_name(self):
         world_name = self.parse_pstring()
@@ -797,11 +1459,52 @@ class WorldDatParser(Parser):
                 self.dump_pstring()
 
 def main():
-    world_dat_path = sys.argv[1] if len(sys.argv) > 1 else 'world.dat'
+    global digest_dumps
+    args = sys.argv[1:]
+    assume = None
+    if args[:1] == ['--assume-version']:
+        # Parse unknown versions as if they were the given version
+        assume = int(args[1])
+        args = args[2:]
+    if args[:1] == ['--digest']:
+        # Summarize Bytes and Rest regions instead of hexdumping them
+        digest_dumps = True
+        args = args[1:]
+    if args[:1] == ['--scan']:
+        # --scan 30 a/world.dat b/world.dat ...
+        # --scan 4.1 ... descends into nested tuples
+        path = [int(i) for i in args[1].split('.')]
+        regions = []
+        for world_dat_path in args[2:]:
+            with open(world_dat_path, 'rb') as world_dat_fp:
+                fp = RecallFile(world_dat_fp)
+                world_dat = get_world_schema(read_version(fp), assume)
+                regions.append(read_region(world_dat, path, fp))
+        for c in scan_regions(regions):
+            print('0x%04x %-16s %.2f %s' % (c.offset, c.kind, c.score,
+                stats(c.details) if c.kind.startswith('vector')
+                else c.details[0]))
+        return
+    if args[:1] == ['--sqlite']:
+        # --sqlite worlds.db a/world.dat b/world.dat ...
+        export_sqlite(args[1], args[2:], assume=assume, log=print)
+        return
+    cache = None
+    if args[:1] == ['--cache']:
+        cache = ParseCache(args[1])
+        args = args[2:]
+    world_dat_path = args[0] if args else 'world.dat'
     with open(world_dat_path, 'rb') as world_dat_fp:
         #world_dat = WorldDatParser(world_dat_fp, sys.stdout)
         #world_dat.dump()
-        for line in world_dat.dump(RecallFile(world_dat_fp)):
+        fp = RecallFile(world_dat_fp)
+        world_dat = get_world_schema(read_version(fp), assume)
+        if cache is not None:
+            sections = cache.parse(world_dat, fp)
+            for i, section in enumerate(sections):
+                print('.%d %r' % (i, section))
+            return
+        for line in world_dat.dump(fp):
             print(line)
         #for line in world_header.dump(RecallFile(world_dat_fp)):
         #    print(line)
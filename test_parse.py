@@ -0,0 +1,302 @@
+import io
+import struct
+
+import pytest
+
+import parse
+from parse import *
+
+def pstring(b):
+    return struct.pack('<h', len(b)) + b
+
+def sample(fmt):
+    # Bytes of a small valid instance of fmt, with one element per vector
+    # and two SUBTERRANEAN_ANIMAL_PEOPLES records.
+    if isinstance(fmt, (Skip, Memo)):
+        return sample(fmt.args[0])
+    if isinstance(fmt, Tuple):
+        return b''.join(sample(f) for f in fmt.args[0])
+    if isinstance(fmt, Array):
+        return int(fmt.args[0]) * sample(fmt.args[1])
+    if isinstance(fmt, VectorInt):
+        return struct.pack('<i', 1) + sample(fmt.args[0])
+    if isinstance(fmt, NamedTuple):
+        return len(fmt.args[0]) * sample(fmt.args[1])
+    if isinstance(fmt, DFNamedSections):
+        return (2 * (pstring(b'SUBTERRANEAN_ANIMAL_PEOPLES')
+                    + sample(fmt.args[0]))
+                + pstring(b'MOUNTAIN') + sample(fmt.args[1]))
+    if isinstance(fmt, Expect):
+        if isinstance(fmt.args[0], Struct):
+            return fmt.args[0]._struct.pack(fmt.args[1])
+        return pstring(fmt.args[1].encode('cp437'))
+    if isinstance(fmt, ExpectZeros):
+        return bytes(int(fmt.args[0]))
+    if isinstance(fmt, ExpectBytes):
+        return fmt.args[0]
+    if isinstance(fmt, Struct):
+        return fmt._struct.pack(1)
+    if isinstance(fmt, (Pstring, DFstring)):
+        return pstring(b'AB')
+    if isinstance(fmt, Bytes):
+        return bytes(i % 256 for i in range(fmt.args[0]))
+    if isinstance(fmt, (Output, Break)):
+        return b''
+    raise TypeError(fmt)
+
+def sample_world_dat():
+    return struct.pack('<h', 1205) + sample(build_world_dat())[2:]
+
+def write_world_dat(tmp_path, name='world.dat'):
+    path = tmp_path / name
+    path.write_bytes(sample_world_dat())
+    return str(path)
+
+def parse_file(path, fmt=None):
+    with open(path, 'rb') as f:
+        fp = RecallFile(f)
+        if fmt is None:
+            fmt = get_world_schema(read_version(fp))
+        return fmt.parse(fp), fp.tell()
+
+def test_parse_world_dat(tmp_path):
+    path = write_world_dat(tmp_path)
+    result, pos = parse_file(path)
+    assert pos == len(sample_world_dat())
+    # Last position: Bytes(28), then 16 names
+    assert result[-1] == [['AB']] * 16
+
+def test_parse_cache(tmp_path):
+    path = write_world_dat(tmp_path)
+    expected, end = parse_file(path)
+    cache = ParseCache(str(tmp_path / 'cache'))
+    for i in range(2):
+        with open(path, 'rb') as f:
+            fp = RecallFile(f)
+            assert cache.parse(build_world_dat(), fp) == expected
+            assert fp.tell() == end
+
+def test_parse_cache_reuses_sections(tmp_path, monkeypatch):
+    path = write_world_dat(tmp_path)
+    cache = ParseCache(str(tmp_path / 'cache'))
+    with open(path, 'rb') as f:
+        cache.parse(build_world_dat(), RecallFile(f))
+    patch(path, [([9], bytes(28))])  # MONARCH flags
+    expected, end = parse_file(path)
+    stored = []
+    store = cache._store
+    def counting(key, value):
+        stored.append(key)
+        store(key, value)
+    monkeypatch.setattr(cache, '_store', counting)
+    with open(path, 'rb') as f:
+        fp = RecallFile(f)
+        assert cache.parse(build_world_dat(), fp) == expected
+        assert fp.tell() == end
+    # Only the edited section and the new index are decoded and stored
+    assert len(stored) == 2
+    assert stored[-1].startswith('index-')
+
+def test_parse_cache_evicts(tmp_path):
+    cache = ParseCache(str(tmp_path / 'cache'), max_size=100)
+    for i in range(10):
+        cache._store('entry-%d' % i, bytes(30))
+    assert cache._size <= 100
+    assert sorted(os.listdir(str(tmp_path / 'cache'))) == sorted(cache._entries)
+    assert 'entry-9' in cache._entries
+
+def test_unknown_version():
+    with pytest.raises(Exception, match='No schema'):
+        get_world_schema(1)
+    assert get_world_schema(1, assume=1205) is build_world_dat()
+
+def test_read_region(tmp_path):
+    path = write_world_dat(tmp_path)
+    with open(path, 'rb') as f:
+        assert read_region(build_world_dat(), [3], RecallFile(f)) == \
+                sample(Bytes(0x100))
+        # MONARCH flags
+        f.seek(0)
+        assert read_region(build_world_dat(), [9], RecallFile(f)) == \
+                sample(Bytes(28))
+
+def test_scan_regions():
+    pytest.importorskip('numpy')
+    regions = [bytes(8) + struct.pack('<i', n) + struct.pack('<%dh' % n, *range(n))
+            + pstring(b'MAYOR') for n in (2, 3)]
+    best = scan_regions(regions)
+    # The counted vector of shorts is consistent; the same counts read as
+    # ints are not.
+    scores = {(c.offset, c.kind): c.score for c in best}
+    assert scores[8, 'vector_of_short'] > scores.get((8, 'vector_of_int'), 0)
+    assert scores[0, 'same'] < 1.0
+
+def test_scan_regions_zero_run():
+    pytest.importorskip('numpy')
+    regions = [bytes(40) + struct.pack('<i', n)
+            + struct.pack('<%di' % n, *range(1, n + 1)) + pstring(b'MAYOR')
+            for n in (2, 3, 4)]
+    best = scan_regions(regions)
+    empty = [c for c in best
+            if c.kind.startswith('vector') and not any(c.details)]
+    assert len(empty) <= 2
+    scores = {(c.offset, c.kind): c.score for c in best}
+    real = scores[40, 'vector_of_int']
+    assert real > max(c.score for c in empty)
+    assert real > scores.get((40, 'vector_of_short'), 0)
+    assert (40, 'vector_of_int', real, [2, 3, 4]) in best[:3]
+
+def test_patch_in_place(tmp_path):
+    path = write_world_dat(tmp_path)
+    size = os.path.getsize(path)
+    flags = bytes(range(100, 128))
+    patch(path, [
+        ([9], flags),  # MONARCH flags
+        ([10, 3, 0], 'XY'),  # Fourth MONARCH name
+        ([5, 2, 0], 7),  # MOUNTAIN
+        ([5, 1, 2], 9),  # Second SUBTERRANEAN_ANIMAL_PEOPLES
+    ])
+    assert os.path.getsize(path) == size
+    result, pos = parse_file(path)
+    assert pos == size
+    assert result[9] == flags
+    assert result[10][3] == ['XY']
+    assert result[5][2][0] == 7
+    assert result[5][1][2] == 9
+
+def test_patch_resize(tmp_path):
+    path = write_world_dat(tmp_path)
+    os.chmod(path, 0o640)
+    patch(path, [([10, 0, 0], 'A longer name')])
+    result, pos = parse_file(path)
+    assert pos == os.path.getsize(path)
+    assert result[10][0] == ['A longer name']
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    with pytest.raises(Exception):
+        patch(path, [([8], 'GENERAL')])
+    assert os.listdir(str(tmp_path)) == ['world.dat']
+
+def test_patch_resize_failure(tmp_path, monkeypatch):
+    path = write_world_dat(tmp_path)
+    def fail(src, dest, n):
+        raise OSError("disk full")
+    monkeypatch.setattr(parse, 'copy_range', fail)
+    with pytest.raises(OSError):
+        patch(path, [([10, 0, 0], 'A longer name')])
+    assert os.listdir(str(tmp_path)) == ['world.dat']
+    assert open(path, 'rb').read() == sample_world_dat()
+
+def test_memo_shares_records(tmp_path):
+    parse.memo_cache.clear()
+    def records(path):
+        with open(path, 'rb') as f:
+            return build_world_dat().parse(RecallFile(f))[5]
+    first = records(write_world_dat(tmp_path))
+    # Both SUBTERRANEAN_ANIMAL_PEOPLES records are byte-identical
+    assert first[0] is first[1]
+    second = records(write_world_dat(tmp_path, 'other.dat'))
+    assert second[0] is first[0]
+
+def test_memo_walk(tmp_path):
+    parse.memo_cache.clear()
+    path = write_world_dat(tmp_path)
+    with open(path, 'rb') as f:
+        rows = list(walk(build_world_dat(), RecallFile(f)))
+    records = [(p[3:], v) for p, v in rows
+            if p[:2] == (5, 'SUBTERRANEAN_ANIMAL_PEOPLES')]
+    assert records and records == [(p[3:], v) for p, v in rows
+            if p[:3] == (5, 'SUBTERRANEAN_ANIMAL_PEOPLES', 0)] * 2
+    assert any(key[0] == 'walk' for key in parse.memo_cache._entries)
+
+def test_memo_cache_bound():
+    cache = MemoCache(max_size=1000)
+    for i in range(100):
+        cache.put(i, tuple(range(i, i + 10)))
+    assert 0 < cache._size <= 1000
+    assert 99 in cache._entries
+
+def test_export_sqlite(tmp_path):
+    import sqlite3
+    path = write_world_dat(tmp_path)
+    bad = tmp_path / 'bad.dat'
+    bad.write_bytes(struct.pack('<h', 1300) + sample_world_dat()[2:])
+    db = str(tmp_path / 'worlds.db')
+    lines = export_sqlite(db, [str(bad), path])
+    assert lines[0].startswith('Failed %s: No schema' % bad)
+    assert lines[1].startswith('Loaded %s' % path)
+    assert export_sqlite(db, [path]) == ['Skipping %s (already loaded)' % path]
+
+    with open(path, 'rb') as f:
+        expected = len(list(walk(build_world_dat(), RecallFile(f))))
+    conn = sqlite3.connect(db)
+    assert conn.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+    assert conn.execute('SELECT COUNT(*) FROM files').fetchone() == (1,)
+    assert conn.execute('SELECT COUNT(*) FROM fields').fetchone() == (expected,)
+    indexes = {name for name, in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert {'fields_file', 'fields_section', 'fields_path'} <= indexes
+    # Position names are recorded next to their names
+    assert conn.execute("SELECT section FROM fields WHERE value = 'MONARCH'"
+            ).fetchone() == (8,)
+    conn.close()
+
+def test_skip_past_eof():
+    data = struct.pack('<ii', 3, 1)
+    fp = RecallFile(io.BytesIO(data))
+    with pytest.raises(Exception, match='Unexpected end of file'):
+        list(Skip(VectorInt(Int())).dump(fp))
+    fp.seek(0)
+    fp.push()
+    with pytest.raises(Exception, match='Unexpected end of file'):
+        VectorInt(Int()).skip(fp)
+
+def test_read_chunks(monkeypatch):
+    monkeypatch.setattr(parse, 'chunk_size', 16)
+    data = bytes(range(50))
+    fp = RecallFile(io.BytesIO(data))
+    assert [len(s) for s in fp.read_chunks(40)] == [16, 16, 8]
+    assert b''.join(fp.read_chunks()) == data[40:]
+
+def test_recall_skip():
+    fp = RecallFile(io.BytesIO(bytes(range(20))))
+    fp.skip(5)
+    assert fp.tell() == 5
+    fp.push()
+    fp.skip(3)
+    assert fp.pop() == bytes([5, 6, 7])
+    fp.skip()
+    assert fp.tell() == 20
+
+def test_chunked_dump(monkeypatch):
+    monkeypatch.setattr(parse, 'chunk_size', 32)
+    data = bytes(range(100)) * 3
+    fp = RecallFile(io.BytesIO(data))
+    assert list(Bytes(200).dump(fp)) == list(hexdump(0, data[:200]))
+    assert list(Rest().dump(fp)) == list(hexdump(200, data[200:]))
+
+def test_digest():
+    import random
+    import re
+    random.seed(1)
+    for i in range(300):
+        data = b''.join(random.choice(
+            [bytes(random.randint(1, 40)), b'a' * random.randint(1, 5)])
+            for j in range(20))
+        runs = ['%08x  %d zero bytes' % (5 + m.start(), m.end() - m.start())
+                for m in re.finditer(b'\0+', data) if m.end() - m.start() >= 8]
+        n = random.randint(1, 20)
+        chunks = [data[k:k+n] for k in range(0, len(data), n)]
+        lines = list(digest(5, chunks, min_run=8))
+        assert lines[:-1] == runs
+        assert lines[-1] == '%08x  %d bytes, %d zero, sha256 %s' % (
+                5, len(data), data.count(0), hashlib.sha256(data).hexdigest())
+
+def test_digest_dumps(monkeypatch):
+    data = bytes(300) + b'x'
+    fp = RecallFile(io.BytesIO(data))
+    assert list(Rest().dump(fp)) == list(hexdump(0, data))
+    monkeypatch.setattr(parse, 'digest_dumps', True)
+    fp.seek(0)
+    assert list(Rest().dump(fp)) == list(digest(0, [data]))
+    fp.seek(0)
+    assert len(list(Bytes(300, digest=False).dump(fp))) == 19